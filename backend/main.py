@@ -1,12 +1,30 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict, Optional
-from openai import OpenAI
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from typing import Counter, Deque, List, Dict, Optional, Set, Tuple
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+)
 from enum import Enum
+from contextlib import asynccontextmanager
+import asyncio
+import collections
+import itertools
 import os
+import random
+import re
+import time
+import httpx
 import json
 import logging
+import numpy as np
+import orjson
+import zlib
 from dotenv import load_dotenv
 from datetime import datetime
 
@@ -18,19 +36,130 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-app = FastAPI()
-
-# Enable CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, replace with specific origins
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+# The async client keeps the event loop free while OpenAI requests are in flight;
+# the connection pool is sized so a burst of concurrent users doesn't starve it.
+# Retries are handled in create_chat_completion so the client's own don't multiply them.
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=100)),
 )
 
+# Model used to parse orders; set OPENAI_MODEL to use a fine-tuned model instead.
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+# Rate limiting for OpenAI calls
+MAX_CONCURRENT_REQUESTS = 5
+MAX_RETRIES = 5
+openai_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+# APIConnectionError also covers timeouts
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_reset_duration(value: Optional[str]) -> float:
+    """Convert an OpenAI reset header like "6m0s" or "20ms" to seconds."""
+    if not value:
+        return 0.0
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION_PART.findall(value))
+
+class RateLimiter:
+    """Tracks the remaining RPM/TPM budget reported in OpenAI response headers
+    and waits for the window to reset before sending a request that would be
+    rejected with a 429."""
+
+    def __init__(self):
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        # The two budgets reset independently, so track when each one does
+        self.requests_reset_at: float = 0.0
+        self.tokens_reset_at: float = 0.0
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def reserve(self, estimated_tokens: int):
+        async with self._lock:
+            out_of_requests = self.remaining_requests is not None and self.remaining_requests < 1
+            out_of_tokens = self.remaining_tokens is not None and self.remaining_tokens < estimated_tokens
+            if out_of_requests or out_of_tokens:
+                # Only wait for the budgets that are actually exhausted
+                reset_at = max(
+                    self.requests_reset_at if out_of_requests else 0.0,
+                    self.tokens_reset_at if out_of_tokens else 0.0,
+                )
+                delay = reset_at - time.monotonic()
+                if delay > 0:
+                    logger.warning(f"OpenAI rate limit budget exhausted, waiting {delay:.2f}s")
+                    await asyncio.sleep(delay)
+                # Those windows have reset; the next response will tell us the new budget
+                if out_of_requests:
+                    self.remaining_requests = None
+                if out_of_tokens:
+                    self.remaining_tokens = None
+            if self.remaining_requests is not None:
+                self.remaining_requests -= 1
+            if self.remaining_tokens is not None:
+                self.remaining_tokens -= estimated_tokens
+        yield
+
+    def update(self, headers: httpx.Headers) -> None:
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            self.remaining_requests = int(remaining_requests)
+        if remaining_tokens is not None:
+            self.remaining_tokens = int(remaining_tokens)
+        now = time.monotonic()
+        self.requests_reset_at = now + parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+        self.tokens_reset_at = now + parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+
+rate_limiter = RateLimiter()
+
+def estimate_tokens(messages: List[dict]) -> int:
+    # Roughly 4 characters per token for English text
+    return sum(len(message["content"]) for message in messages) // 4
+
+@asynccontextmanager
+async def create_chat_completion(**kwargs):
+    """Call the chat completions API under the concurrency cap and rate limiter,
+    retrying with exponential backoff on 429s, 5xx errors, timeouts and
+    connection errors.
+
+    Used as an async context manager so a streamed response keeps its slot
+    under the concurrency cap until the stream has been read and closed."""
+    estimated_tokens = estimate_tokens(kwargs["messages"])
+    completions = client.chat.completions
+    for attempt in range(MAX_RETRIES):
+        await openai_semaphore.acquire()
+        try:
+            async with rate_limiter.reserve(estimated_tokens):
+                raw_response = await completions.with_raw_response.create(**kwargs)
+            break
+        except RETRYABLE_ERRORS as e:
+            openai_semaphore.release()
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            logger.warning(f"OpenAI request failed ({type(e).__name__}), retrying in {delay:.2f}s (attempt {attempt + 1}/{MAX_RETRIES})")
+            await asyncio.sleep(delay)
+        except BaseException:
+            openai_semaphore.release()
+            raise
+    try:
+        rate_limiter.update(raw_response.headers)
+        response = raw_response.parse()
+        # Streamed responses don't carry usage, and parse_order stops reading
+        # before the final usage chunk, so this only logs batched calls
+        usage = getattr(response, "usage", None)
+        if usage and usage.prompt_tokens_details:
+            logger.info(f"Prompt tokens: {usage.prompt_tokens} ({usage.prompt_tokens_details.cached_tokens} cached)")
+        yield response
+    finally:
+        # Closes a stream that wasn't read to the end; a no-op otherwise
+        await raw_response.http_response.aclose()
+        openai_semaphore.release()
+
 # Enums for item types
 class ItemType(str, Enum):
     BURGER = "burger"
@@ -42,28 +171,53 @@ class ActionType(str, Enum):
     CANCEL = "cancel"
 
 # Models
+# Keeps item totals far from the 64-bit integer limit of the JSON encoder
+MAX_QUANTITY = 100
+# Enums are stored as their plain string values, so dumping needs no conversion
+MODEL_CONFIG = ConfigDict(extra="forbid", use_enum_values=True, frozen=True)
+
 class OrderItem(BaseModel):
+    model_config = MODEL_CONFIG
+
     item_type: ItemType
-    quantity: int
+    quantity: int = Field(strict=True, ge=1, le=MAX_QUANTITY)
 
 class OrderHistoryItem(BaseModel):
+    model_config = MODEL_CONFIG
+
     id: int
     action_type: ActionType
     items: List[OrderItem]
     timestamp: datetime
     display_message: Optional[str] = None
 
+ORDER_ITEMS_ADAPTER = TypeAdapter(List[OrderItem])
+
 class OrderRequest(BaseModel):
+    model_config = MODEL_CONFIG
+
     message: str
 
-# In-memory storage
-order_history: List[OrderHistoryItem] = []
-next_history_id: int = 1
-item_totals = {
-    ItemType.BURGER: 0,
-    ItemType.FRIES: 0,
-    ItemType.DRINK: 0
-}
+# In-memory storage; the history is bounded so memory doesn't grow forever
+MAX_HISTORY = 10_000
+order_history: Deque[OrderHistoryItem] = collections.deque(maxlen=MAX_HISTORY)
+# Comma-separated JSON encoding of order_history, extended as each item is
+# added, along with the encoded size of each item so the oldest can be dropped
+order_history_json = bytearray()
+order_history_json_sizes: Deque[int] = collections.deque(maxlen=MAX_HISTORY)
+history_id_counter = itertools.count(1)
+# Serializes mutations of the storage below across concurrent requests
+history_lock = asyncio.Lock()
+# Orders that can still be cancelled, by id, so cancelling by order number
+# doesn't scan the history; orders leave it once they fall out of the history
+orders_by_id: Dict[int, OrderHistoryItem] = {}
+# Keyed by the plain item type strings the models store, which orjson can
+# encode directly
+item_totals: Counter[str] = collections.Counter({
+    ItemType.BURGER.value: 0,
+    ItemType.FRIES.value: 0,
+    ItemType.DRINK.value: 0
+})
 
 # OpenAI function definitions
 order_functions = [
@@ -84,7 +238,8 @@ order_functions = [
                             },
                             "quantity": {
                                 "type": "integer",
-                                "minimum": 1
+                                "minimum": 1,
+                                "maximum": MAX_QUANTITY
                             }
                         },
                         "required": ["item_type", "quantity"]
@@ -111,7 +266,8 @@ order_functions = [
                             },
                             "quantity": {
                                 "type": "integer",
-                                "minimum": 1
+                                "minimum": 1,
+                                "maximum": MAX_QUANTITY
                             }
                         },
                         "required": ["item_type", "quantity"]
@@ -123,45 +279,417 @@ order_functions = [
     }
 ]
 
+order_tools = [{"type": "function", "function": function} for function in order_functions]
+
+# The structured output for one message is tiny, so cap generation length
+MAX_OUTPUT_TOKENS = 128
+
+SYSTEM_PROMPT = """You are a drive-thru order processing assistant. Your job is to parse customer orders and cancellations and convert them into structured data using the provided functions.
+
+RULES:
+1. ALWAYS return a function call - never return a regular message
+2. Any mention of food or drinks is an order (place_order); any mention of cancelling is a cancellation (cancel_items)
+3. Map every item to one of three item types:
+   - burger: burger, hamburger, cheeseburger
+   - fries: fries, fry, onion fries, curly fries, sweet potato fries ("a fry" and "an order of fries" both mean one fries)
+   - drink: ANY beverage, including tea, coffee, water, juice, Coke, Pepsi, Sprite or any other drink name
+4. Quantity defaults to 1; "a", "an" and "one" all mean 1
+5. Include every item mentioned in the items array; "and" separates items and their order doesn't matter
+6. To cancel a specific order, use items=[{"order_number": X}]; the number may be written with or without "#"
+7. To cancel all orders or everything, use items=[{"cancel_all": true}]
+8. Otherwise a cancellation lists the exact items and quantities to cancel"""
+
+# Few-shot examples; only the ones most similar to the customer's message are
+# sent with each request
+PROMPT_EXAMPLES = [
+    ("I want a burger", 'place_order with items=[{"item_type": "burger", "quantity": 1}]'),
+    ("I want a fry", 'place_order with items=[{"item_type": "fries", "quantity": 1}]'),
+    ("I want coke", 'place_order with items=[{"item_type": "drink", "quantity": 1}]'),
+    ("I would like one burger and an order of fries", 'place_order with items=[{"item_type": "burger", "quantity": 1}, {"item_type": "fries", "quantity": 1}]'),
+    ("I want a burger and a drink", 'place_order with items=[{"item_type": "burger", "quantity": 1}, {"item_type": "drink", "quantity": 1}]'),
+    ("Give me fries and a drink", 'place_order with items=[{"item_type": "fries", "quantity": 1}, {"item_type": "drink", "quantity": 1}]'),
+    ("Can I get a burger, fries, and a drink", 'place_order with items=[{"item_type": "burger", "quantity": 1}, {"item_type": "fries", "quantity": 1}, {"item_type": "drink", "quantity": 1}]'),
+    ("I want to cancel my burger", 'cancel_items with items=[{"item_type": "burger", "quantity": 1}]'),
+    ("Cancel order number 1", 'cancel_items with items=[{"order_number": 1}]'),
+    ("I want to cancel order #4", 'cancel_items with items=[{"order_number": 4}]'),
+    ("Cancel all my orders", 'cancel_items with items=[{"cancel_all": true}]'),
+    ("I want to cancel everything", 'cancel_items with items=[{"cancel_all": true}]'),
+]
+
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+
+BATCHED REQUESTS:
+You will receive several customer messages at once as a JSON array of strings. Call process_orders exactly once with one result per array element.
+Each result must use the element's 1-based position in the array as its index and contain the function and items you would have used for that message on its own."""
+
+# Prebuilt system messages, shared by every request and never mutated
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+BATCH_SYSTEM_MESSAGE = {"role": "system", "content": BATCH_SYSTEM_PROMPT}
+
+# Function used to parse several customer messages in a single completion
+batch_order_function = {
+    "name": "process_orders",
+    "description": "Record the parsed order or cancellation for each numbered customer message",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "index": {
+                            "type": "integer",
+                            "minimum": 1
+                        },
+                        "function": {
+                            "type": "string",
+                            "enum": [function["name"] for function in order_functions]
+                        },
+                        "items": order_functions[1]["parameters"]["properties"]["items"]
+                    },
+                    "required": ["index", "function", "items"]
+                }
+            }
+        },
+        "required": ["results"]
+    }
+}
+
+# Fast path for simple messages that don't need OpenAI
+CANCEL_ALL = re.compile(r"\bcancel\s+(?:everything|(?:all|every)\s+(?:of\s+)?(?:my\s+|the\s+)?orders?)\b", re.I)
+CANCEL_ORDER = re.compile(r"\bcancel\s+(?:my\s+|the\s+)?order\s*(?:number\s*)?#?\s*(\d+)\b(?!\s*(?:,|&|and\b))", re.I)
+WORD = re.compile(r"[a-z]+|\d+")
+
+ITEM_WORDS = {
+    **dict.fromkeys(["burger", "burgers", "hamburger", "hamburgers", "cheeseburger", "cheeseburgers"], ItemType.BURGER),
+    **dict.fromkeys(["fry", "fries"], ItemType.FRIES),
+    **dict.fromkeys(["drink", "drinks", "coke", "cokes", "pepsi", "sprite", "tea", "coffee", "water", "juice", "soda", "sodas"], ItemType.DRINK),
+}
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+# Words that can appear in a simple order without changing its meaning; any
+# other word makes the message ambiguous and it goes to OpenAI instead
+FILLER_WORDS = {
+    "i", "id", "ill", "im", "want", "would", "like", "give", "me", "can", "could", "get",
+    "take", "have", "please", "and", "of", "order", "orders", "some", "my", "the", "to", "just",
+}
+# Filler words that ask for something; after "cancel" they mean the message
+# also places an order, which the local parser can't represent
+ORDER_VERBS = {"want", "like", "give", "get", "take", "have", "order", "orders"}
+
+def message_words(text: str) -> List[str]:
+    return WORD.findall(text.lower().replace("'", ""))
+
+def is_filler(text: str) -> bool:
+    return all(word in FILLER_WORDS for word in message_words(text))
+
+def match_simple_order(message: str) -> Optional[Tuple[str, dict]]:
+    """Parse unambiguous orders and cancellations locally. Returns the function
+    name and arguments OpenAI would have produced, or None to fall through."""
+    # Cancelling whole orders is destructive, so only take the shortcut when
+    # nothing but filler surrounds the cancellation
+    for pattern in (CANCEL_ALL, CANCEL_ORDER):
+        match = pattern.search(message)
+        if match:
+            if not is_filler(message[:match.start()] + " " + message[match.end():]):
+                return None
+            if pattern is CANCEL_ALL:
+                return "cancel_items", {"items": [{"cancel_all": True}]}
+            return "cancel_items", {"items": [{"order_number": int(match.group(1))}]}
+
+    is_cancel = False
+    quantity = None
+    items = []
+    for word in message_words(message):
+        if word == "cancel":
+            # Items before "cancel" would be orders mixed into a cancellation
+            if items or quantity is not None:
+                return None
+            is_cancel = True
+        elif word in ITEM_WORDS:
+            items.append({"item_type": ITEM_WORDS[word].value, "quantity": 1 if quantity is None else quantity})
+            quantity = None
+        elif word.isdigit() or word in NUMBER_WORDS:
+            if quantity is not None:
+                return None
+            quantity = int(word) if word.isdigit() else NUMBER_WORDS[word]
+            if not 1 <= quantity <= MAX_QUANTITY:
+                return None
+        elif is_cancel and word in ORDER_VERBS:
+            return None
+        elif word not in FILLER_WORDS:
+            return None
+    if not items or quantity is not None:
+        return None
+    return ("cancel_items" if is_cancel else "place_order"), {"items": items}
+
+# Example retrieval. Messages are embedded locally as hashed bag-of-words
+# vectors (unigrams and bigrams), which is plenty for picking between short
+# order phrases and avoids an embeddings API round-trip per request
+EMBEDDING_DIM = 256
+EXAMPLES_PER_MESSAGE = 3
+
+def embed_text(text: str) -> np.ndarray:
+    words = WORD.findall(text.lower())
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for token in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        vector[zlib.crc32(token.encode()) % EMBEDDING_DIM] += 1
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Rows are unit length, so a dot product gives cosine similarity
+EXAMPLE_EMBEDDINGS = np.stack([embed_text(user_text) for user_text, _ in PROMPT_EXAMPLES])
+
+def select_examples(messages: List[str]) -> dict:
+    """Build a system message with the examples closest to the given messages."""
+    scores = EXAMPLE_EMBEDDINGS @ np.stack([embed_text(message) for message in messages]).T
+    top = np.argsort(-scores, axis=0)[:EXAMPLES_PER_MESSAGE]
+    # Keep each selected example once, in corpus order
+    indices = sorted(set(top.ravel().tolist()))
+    examples = "\n\n".join(
+        f'User: "{PROMPT_EXAMPLES[index][0]}"\nResponse: {PROMPT_EXAMPLES[index][1]}' for index in indices
+    )
+    return {"role": "system", "content": f"EXAMPLES:\n{examples}"}
+
+async def parse_order(message: str) -> Tuple[str, dict]:
+    """Ask OpenAI to map a single customer message to a function call.
+
+    The completion is streamed so we can stop reading as soon as the function
+    arguments form a complete JSON object."""
+    logger.info("Calling OpenAI API...")
+    model = response_id = function_name = None
+    content = ""
+    arguments = ""
+    args = None
+    async with create_chat_completion(
+        model=OPENAI_MODEL,
+        messages=[
+            SYSTEM_MESSAGE,
+            select_examples([message]),
+            {"role": "user", "content": message}
+        ],
+        tools=order_tools,
+        tool_choice="required",
+        # Only the first tool call is read from the stream
+        parallel_tool_calls=False,
+        max_tokens=MAX_OUTPUT_TOKENS,
+        stream=True
+    ) as stream:
+        async for chunk in stream:
+            model, response_id = chunk.model, chunk.id
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content += delta.content
+            if delta.tool_calls:
+                function = delta.tool_calls[0].function
+                if function.name:
+                    function_name = function.name
+                if function.arguments:
+                    arguments += function.arguments
+                    # Only try to parse once the braces balance, so the arguments are
+                    # decoded a single time instead of on every closing brace
+                    if "}" in function.arguments and arguments.count("{") == arguments.count("}"):
+                        try:
+                            args = json.loads(arguments)
+                            break
+                        except json.JSONDecodeError:
+                            pass
+
+    # Log the relevant parts of the OpenAI response
+    logger.info(f"OpenAI API Response - Model: {model}, ID: {response_id}")
+    logger.info(f"First choice message: {content or None}")
+    if not function_name:
+        logger.warning(f"No valid order found in message: {message}")
+        raise HTTPException(status_code=400, detail="Could not understand the order. Please try rephrasing your request.")
+
+    logger.info(f"Function call: {function_name}")
+    if args is None:
+        logger.error(f"Failed to parse function arguments: {arguments}")
+        raise HTTPException(status_code=500, detail="Failed to parse order details")
+    logger.info("Parsed arguments: %s", args)
+    return function_name, args
+
+async def parse_order_batch(messages: List[str]) -> List[Tuple[str, dict]]:
+    """Parse several customer messages with one completion, returning the
+    function call for each message in the order they were given."""
+    # Encoded as a JSON array so one caller's text can't forge another's entry
+    batch_content = json.dumps(messages)
+    logger.info(f"Calling OpenAI API with a batch of {len(messages)} messages...")
+    async with create_chat_completion(
+        model=OPENAI_MODEL,
+        messages=[
+            BATCH_SYSTEM_MESSAGE,
+            select_examples(messages),
+            {"role": "user", "content": batch_content}
+        ],
+        tools=[{"type": "function", "function": batch_order_function}],
+        tool_choice={"type": "function", "function": {"name": batch_order_function["name"]}},
+        max_tokens=MAX_OUTPUT_TOKENS * len(messages)
+    ) as response:
+        logger.info(f"OpenAI API Response - Model: {response.model}, ID: {response.id}")
+
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls:
+        raise HTTPException(status_code=500, detail="Failed to parse order details")
+    try:
+        results = json.loads(tool_calls[0].function.arguments)["results"]
+    except (json.JSONDecodeError, KeyError):
+        logger.error(f"Failed to parse batch arguments: {tool_calls[0].function.arguments}")
+        raise HTTPException(status_code=500, detail="Failed to parse order details")
+
+    # Keep the first result for each index if the model repeats one
+    by_index = {}
+    for result in results:
+        by_index.setdefault(result.get("index"), result)
+    parsed = []
+    for index, message in enumerate(messages, start=1):
+        result = by_index.get(index)
+        if not result or "function" not in result:
+            logger.warning(f"No valid order found in message: {message}")
+            parsed.append(None)
+        else:
+            # A result without items gets no items argument, so it's rejected
+            # the same way as a single message without items
+            args = {key: value for key, value in result.items() if key == "items"}
+            parsed.append((result["function"], args))
+    return parsed
+
+# Micro-batching of OpenAI calls
+BATCH_MAX = 16
+BATCH_WINDOW_MS = 10
+
+class OrderBatcher:
+    """Collects messages arriving within a short window and parses them with a
+    single OpenAI call, so concurrent users share the system prompt cost."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, message: str) -> Tuple[str, dict]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((message, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + BATCH_WINDOW_MS / 1000
+            while len(batch) < BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch in the background so the next window can start collecting
+            task = asyncio.create_task(self._dispatch(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        messages = [message for message, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            if len(batch) == 1:
+                results = [await parse_order(messages[0])]
+            else:
+                results = await parse_order_batch(messages)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if result is None:
+                future.set_exception(HTTPException(status_code=400, detail="Could not understand the order. Please try rephrasing your request."))
+            else:
+                future.set_result(result)
+
+order_batcher = OrderBatcher()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    order_batcher.start()
+    yield
+    await order_batcher.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Enable CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # In production, replace with specific origins
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+def add_history_item(history_item: OrderHistoryItem) -> dict:
+    """Append to the order history and return the item dumped as a dict."""
+    history_dict = history_item.model_dump()
+    history_json = orjson.dumps(history_dict)
+    if len(order_history_json_sizes) == MAX_HISTORY:
+        # The deques are about to drop their oldest item; drop it and its comma
+        # here too, and stop it from being cancelled by number
+        del order_history_json[:order_history_json_sizes[0] + 1]
+        orders_by_id.pop(order_history[0].id, None)
+    if order_history_json:
+        order_history_json.extend(b",")
+    order_history_json.extend(history_json)
+    order_history.append(history_item)
+    order_history_json_sizes.append(len(history_json))
+    return history_dict
+
 def place_order(items: List[dict]) -> dict:
-    global next_history_id
     try:
-        logger.info(f"Attempting to place order with items: {json.dumps(items, indent=2)}")
+        logger.info("Attempting to place order with items: %s", items)
         
-        # Validate items before processing
-        for item in items:
-            if "item_type" not in item:
-                raise ValueError("Missing item_type in order item")
-            if "quantity" not in item:
-                raise ValueError("Missing quantity in order item")
-            try:
-                ItemType(item["item_type"])  # Validate item type
-            except ValueError:
-                raise ValueError(f"Invalid item type: {item['item_type']}")
-            if not isinstance(item["quantity"], int) or item["quantity"] < 1:
-                raise ValueError(f"Invalid quantity: {item['quantity']}")
+        # Validate items in one pass; ValidationError is a ValueError, so bad
+        # items are reported as a 400 below
+        order_items = ORDER_ITEMS_ADAPTER.validate_python(items)
         
-        # Create order history item
-        history_item = OrderHistoryItem(
-            id=next_history_id,
-            action_type=ActionType.ORDER,
-            items=[OrderItem(**item) for item in items],
+        # Create order history item; the items were validated above, so skip
+        # running Pydantic validation on them again
+        history_item = OrderHistoryItem.model_construct(
+            id=next(history_id_counter),
+            action_type=ActionType.ORDER.value,
+            items=order_items,
             timestamp=datetime.now()
         )
-        order_history.append(history_item)
-        next_history_id += 1
+        history_dict = add_history_item(history_item)
+        orders_by_id[history_item.id] = history_item
         
         # Update totals
-        for item in items:
-            item_type = ItemType(item["item_type"])
-            quantity = item["quantity"]
-            item_totals[item_type] += quantity
+        for item in order_items:
+            item_totals[item.item_type] += item.quantity
         
         logger.info(f"Successfully placed order")
         return {
             "status": "success",
             "message": "Order placed successfully",
-            "history": [item.model_dump() for item in order_history],
+            "history_delta": [history_dict],
             "totals": item_totals
         }
     except ValueError as e:
@@ -170,75 +698,46 @@ def place_order(items: List[dict]) -> dict:
     except Exception as e:
         logger.error(f"Error placing order: {str(e)}", exc_info=True)
         logger.error(f"Error type: {type(e).__name__}")
-        logger.error(f"Items that caused error: {json.dumps(items, indent=2)}")
+        logger.error("Items that caused error: %s", items)
         raise HTTPException(status_code=500, detail=f"Failed to place order: {str(e)}")
 
 def cancel_items(items: List[dict]) -> dict:
-    global next_history_id
     try:
-        logger.info(f"Attempting to cancel items: {json.dumps(items, indent=2)}")
+        logger.info("Attempting to cancel items: %s", items)
         
         # Check if this is a cancel all orders request
         if len(items) > 0 and isinstance(items[0], dict) and items[0].get('cancel_all', False):
-            # Get all cancelled order numbers by parsing cancellation messages
-            cancelled_order_ids = set()
-            for item in order_history:
-                if item.action_type == ActionType.CANCEL and item.display_message:
-                    # Check for individual order cancellations
-                    if "Cancelled order #" in item.display_message:
-                        try:
-                            # Extract the order number from messages like "Cancelled order #2: ..."
-                            order_num = int(item.display_message.split("#")[1].split(":")[0])
-                            cancelled_order_ids.add(order_num)
-                        except (IndexError, ValueError):
-                            continue
-                    # Check for "cancel all" operations
-                    elif "Cancelled all orders" in item.display_message:
-                        # All orders up to this point should be considered cancelled
-                        cancelled_order_ids.update(
-                            order.id for order in order_history 
-                            if order.action_type == ActionType.ORDER 
-                            and order.id < item.id
-                        )
-            
-            # Get orders that haven't been cancelled
-            active_orders = [
-                order for order in order_history 
-                if order.action_type == ActionType.ORDER 
-                and order.id not in cancelled_order_ids
-            ]
-            
-            if not active_orders:
+            if not orders_by_id:
                 return {
                     "status": "error",
                     "message": "No active orders to cancel",
                     "display_message": "No active orders to cancel",
-                    "history": [item.model_dump() for item in order_history],
+                    "history_delta": [],
                     "totals": item_totals
                 }
             
             # Reset totals based on active orders
-            for item_type in ItemType:
+            for item_type in item_totals:
                 item_totals[item_type] = 0
             
             # Create cancellation history item with proper grammar
-            order_count = len(active_orders)
+            order_count = len(orders_by_id)
             order_text = "order" if order_count == 1 else "orders"
-            history_item = OrderHistoryItem(
-                id=next_history_id,
-                action_type=ActionType.CANCEL,
+            history_item = OrderHistoryItem.model_construct(
+                id=next(history_id_counter),
+                action_type=ActionType.CANCEL.value,
                 items=[],  # Empty items list for cancel all
                 timestamp=datetime.now(),
                 display_message=f"Cancelled all orders ({order_count} {order_text})"
             )
-            order_history.append(history_item)
-            next_history_id += 1
+            history_dict = add_history_item(history_item)
+            orders_by_id.clear()
             
             return {
                 "status": "success",
                 "message": "All orders cancelled successfully",
                 "display_message": history_item.display_message,
-                "history": [item.model_dump() for item in order_history],
+                "history_delta": [history_dict],
                 "totals": item_totals
             }
         
@@ -247,53 +746,53 @@ def cancel_items(items: List[dict]) -> dict:
         cancelled_order = None
         if len(items) > 0 and isinstance(items[0], dict) and 'order_number' in items[0]:
             order_number = items[0]['order_number']
-            # Find the original order
-            cancelled_order = next((order for order in order_history if order.id == order_number and order.action_type == ActionType.ORDER), None)
+            # Find the original order; cancelled orders are removed from the index
+            cancelled_order = orders_by_id.get(order_number)
             if not cancelled_order:
                 return {
                     "status": "error",
                     "message": f"Order #{order_number} not found or already cancelled",
                     "display_message": f"Error: Order #{order_number} does not exist",
-                    "history": [item.model_dump() for item in order_history],
+                    "history_delta": [],
                     "totals": item_totals
                 }
             # Use the items from the original order for cancellation
-            items = [{"item_type": item.item_type.value, "quantity": item.quantity} for item in cancelled_order.items]
+            items = [{"item_type": item.item_type, "quantity": item.quantity} for item in cancelled_order.items]
         elif not items:  # If no items and no order number
             return {
                 "status": "error",
                 "message": "No items specified for cancellation",
                 "display_message": "Error: No items specified for cancellation",
-                "history": [item.model_dump() for item in order_history],
+                "history_delta": [],
                 "totals": item_totals
             }
         
-        # Create cancellation history item
-        history_item = OrderHistoryItem(
-            id=next_history_id,
-            action_type=ActionType.CANCEL,
-            items=[OrderItem(**item) for item in items],
-            timestamp=datetime.now()
-        )
+        # Create cancellation history item; items for an order-specific
+        # cancellation come straight from the stored order and are already valid
+        order_items = cancelled_order.items if cancelled_order else [OrderItem(**item) for item in items]
         
-        # Create appropriate display message
-        display_message = None
+        # Create appropriate display message once, as the item is created
+        items_str = ", ".join(f"{item['quantity']} {item['item_type']}" for item in items)
         if cancelled_order:
-            items_str = ", ".join(f"{item['quantity']} {item['item_type']}" for item in items)
             display_message = f"Cancelled order #{cancelled_order.id}: {items_str}"
         else:
-            items_str = ", ".join(f"{item['quantity']} {item['item_type']}" for item in items)
             display_message = f"Cancelled: {items_str}"
         
-        # Add display message to history item
-        history_item.display_message = display_message
-        order_history.append(history_item)
-        next_history_id += 1
+        history_item = OrderHistoryItem.model_construct(
+            id=next(history_id_counter),
+            action_type=ActionType.CANCEL.value,
+            items=order_items,
+            timestamp=datetime.now(),
+            display_message=display_message
+        )
+        history_dict = add_history_item(history_item)
+        if cancelled_order:
+            del orders_by_id[cancelled_order.id]
         
         # Update totals
-        for item in items:
-            item_type = ItemType(item["item_type"])
-            quantity = item["quantity"]
+        for item in order_items:
+            item_type = item.item_type
+            quantity = item.quantity
             if item_totals[item_type] >= quantity:
                 item_totals[item_type] -= quantity
             else:
@@ -304,13 +803,13 @@ def cancel_items(items: List[dict]) -> dict:
             "status": "success",
             "message": "Items cancelled successfully",
             "display_message": display_message,
-            "history": [item.model_dump() for item in order_history],
+            "history_delta": [history_dict],
             "totals": item_totals
         }
     except Exception as e:
         logger.error(f"Error cancelling items: {str(e)}", exc_info=True)
         logger.error(f"Error type: {type(e).__name__}")
-        logger.error(f"Items that caused error: {json.dumps(items, indent=2)}")
+        logger.error("Items that caused error: %s", items)
         raise HTTPException(status_code=500, detail=f"Failed to cancel items: {str(e)}")
 
 @app.post("/process-order")
@@ -323,275 +822,57 @@ async def process_order(request: OrderRequest):
     try:
         logger.info(f"Processing order request: {request.message}")
         
-        # Call OpenAI to parse the request
-        logger.info("Calling OpenAI API...")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": """You are a drive-thru order processing assistant. Your job is to parse customer orders and cancellations and convert them into structured data using the provided functions.
-
-IMPORTANT RULES:
-1. ALWAYS return a function call - never return a regular message
-2. For ANY mention of food or drinks, create an order
-3. For ANY mention of cancelling food or drinks, cancel the items
-4. Default quantity is 1 if not specified
-5. Food and drink items:
-   - Burgers: burger, hamburger, cheeseburger
-   - Fries: fries, fry, onion fries, curly fries, sweet potato fries
-   - Drinks: ANY beverage, including:
-     * Tea, coffee, water, juice
-     * Soda: Coke, Pepsi, Sprite, etc.
-     * Any other drink name or description
-
-EXAMPLES:
-Single Item Orders:
-User: "I want a burger"
-Response: place_order with items=[{"item_type": "burger", "quantity": 1}]
-
-User: "I want fries"
-Response: place_order with items=[{"item_type": "fries", "quantity": 1}]
-
-User: "I want a fry"
-Response: place_order with items=[{"item_type": "fries", "quantity": 1}]
-
-User: "I want coke"
-Response: place_order with items=[{"item_type": "drink", "quantity": 1}]
-
-Multiple Item Orders:
-User: "I would like one burger and an order of fries"
-Response: place_order with items=[
-    {"item_type": "burger", "quantity": 1},
-    {"item_type": "fries", "quantity": 1}
-]
-
-User: "I want a burger and a fry"
-Response: place_order with items=[
-    {"item_type": "burger", "quantity": 1},
-    {"item_type": "fries", "quantity": 1}
-]
-
-User: "I want a burger and fries"
-Response: place_order with items=[
-    {"item_type": "burger", "quantity": 1},
-    {"item_type": "fries", "quantity": 1}
-]
-
-User: "I want a fry and a burger"
-Response: place_order with items=[
-    {"item_type": "fries", "quantity": 1},
-    {"item_type": "burger", "quantity": 1}
-]
-
-User: "I want fries and a burger"
-Response: place_order with items=[
-    {"item_type": "fries", "quantity": 1},
-    {"item_type": "burger", "quantity": 1}
-]
-
-User: "I want a burger and a drink"
-Response: place_order with items=[
-    {"item_type": "burger", "quantity": 1},
-    {"item_type": "drink", "quantity": 1}
-]
-
-User: "I want a drink and a burger"
-Response: place_order with items=[
-    {"item_type": "drink", "quantity": 1},
-    {"item_type": "burger", "quantity": 1}
-]
-
-User: "I want a fry and a drink"
-Response: place_order with items=[
-    {"item_type": "fries", "quantity": 1},
-    {"item_type": "drink", "quantity": 1}
-]
-
-User: "I want fries and a drink"
-Response: place_order with items=[
-    {"item_type": "fries", "quantity": 1},
-    {"item_type": "drink", "quantity": 1}
-]
-
-User: "I want a drink and a fry"
-Response: place_order with items=[
-    {"item_type": "drink", "quantity": 1},
-    {"item_type": "fries", "quantity": 1}
-]
-
-User: "I want a drink and fries"
-Response: place_order with items=[
-    {"item_type": "drink", "quantity": 1},
-    {"item_type": "fries", "quantity": 1}
-]
-
-User: "Give me fries and a drink"
-Response: place_order with items=[
-    {"item_type": "fries", "quantity": 1},
-    {"item_type": "drink", "quantity": 1}
-]
-
-User: "Can I get a burger, fries, and a drink"
-Response: place_order with items=[
-    {"item_type": "burger", "quantity": 1},
-    {"item_type": "fries", "quantity": 1},
-    {"item_type": "drink", "quantity": 1}
-]
+        parsed = match_simple_order(request.message)
+        if parsed:
+            logger.info("Parsed order locally without calling OpenAI")
+        else:
+            parsed = await order_batcher.submit(request.message)
+        function_name, args = parsed
 
-Common Order Phrases:
-- "I want X and Y"
-- "Give me X and Y"
-- "Can I get X and Y"
-- "I'd like X and Y"
-- "I'll take X and Y"
-- "I would like X and Y"
-
-Cancellation Examples:
-User: "I want to cancel my burger"
-Response: cancel_items with items=[{"item_type": "burger", "quantity": 1}]
-
-User: "I want to cancel my drink"
-Response: cancel_items with items=[{"item_type": "drink", "quantity": 1}]
-
-User: "Cancel order 1"
-Response: cancel_items with items=[{"order_number": 1}]
-
-User: "Cancel order number 1"
-Response: cancel_items with items=[{"order_number": 1}]
-
-User: "I want to cancel order 1"
-Response: cancel_items with items=[{"order_number": 1}]
-
-User: "Cancel order #1"
-Response: cancel_items with items=[{"order_number": 1}]
-
-User: "Cancel order 4"
-Response: cancel_items with items=[{"order_number": 4}]
-
-User: "Cancel all orders"
-Response: cancel_items with items=[{"cancel_all": true}]
-
-User: "I want to cancel everything"
-Response: cancel_items with items=[{"cancel_all": true}]
-
-User: "Cancel all my orders"
-Response: cancel_items with items=[{"cancel_all": true}]
-
-Common Cancellation Phrases:
-- "Cancel order X"
-- "Cancel order number X"
-- "I want to cancel order X"
-- "Cancel my order X"
-- "Cancel the order X"
-- "Cancel order #X"
-- "Cancel all orders"
-- "Cancel everything"
-- "Cancel all my orders"
-- "I want to cancel all orders"
-
-Remember: 
-1. ALWAYS return a function call
-2. ANY beverage request is a drink order
-3. Quantity defaults to 1
-4. Keep it simple - just map to the three item types: burger, fries, drink
-5. For multiple items, include all items in the items array
-6. "fry" and "fries" both map to the "fries" item type
-7. Common phrases like "I want", "Give me", "Can I get" all indicate an order
-8. The word "and" between items indicates multiple items in one order
-9. When cancelling an order number, ONLY cancel the items from that specific order
-10. Common cancellation phrases include "cancel order", "cancel order number", "I want to cancel order"
-11. The word "fry" (singular) should always be treated as "fries" (plural) in the item_type
-12. The order of items in the response doesn't matter, as long as all items are included
-13. When someone says "a drink", it means one drink
-14. When someone says "a burger", it means one burger
-15. When someone says "a fry" or "fries", it means one order of fries
-16. When cancelling an order, only cancel the exact items from that order, nothing more
-17. The order number in the cancellation request refers to the specific order to cancel
-18. Always include the order_number parameter in the response when cancelling an order
-19. If the order number doesn't exist, return an empty items array and include an error message
-20. The order number can be specified with or without the # symbol
-21. When someone says "a burger and a fry", it means one burger and one order of fries
-22. The order of items in the request doesn't matter (e.g., "a burger and a fry" is the same as "a fry and a burger")
-23. Always return a place_order function call for any food or drink request
-24. When cancelling an order, subtract the exact quantities from the totals
-25. The totals should reflect the current state after all orders and cancellations
-26. "an order of fries" means one order of fries
-27. "one burger" means one burger
-28. Always include a message in the cancellation response showing which order is being cancelled and its items
-29. The cancellation message should follow the format "Cancelling order #X: [items]"
-30. The items in the cancellation message should be listed in the same format as the order history
-31. When cancelling an order, the totals must be updated by subtracting the cancelled items
-32. The UI should clearly show which order is being cancelled and what items are being cancelled
-33. The cancellation message should be displayed in the order history
-34. The totals should be recalculated after each cancellation
-35. The cancellation message should include both the order number and the items being cancelled
-36. Always include a display_message parameter in the response for UI display
-37. The display_message should be in the format "Cancelled order #X: [items]" or "Cancelled: [items]"
-38. The display_message should be clear and concise for the UI
-39. The display_message should be different from the internal message for better UI presentation
-40. The display_message should be used to show the final state of the cancellation in the UI
-41. When someone says to cancel all orders, use the cancel_all parameter
-42. When cancelling all orders, all totals should be reset to 0
-43. The display message for cancel all should show how many orders were cancelled"""},
-                {"role": "user", "content": request.message}
-            ],
-            functions=order_functions,
-            function_call="auto"
-        )
-        
-        # Log the relevant parts of the OpenAI response
-        logger.info(f"OpenAI API Response - Model: {response.model}, ID: {response.id}")
-        logger.info(f"First choice message: {response.choices[0].message.content}")
-        if response.choices[0].message.function_call:
-            function_call = response.choices[0].message.function_call
-            logger.info(f"Function call: {function_call.name}")
-            try:
-                args_dict = json.loads(function_call.arguments)
-                logger.info(f"Arguments: {json.dumps(args_dict, indent=2)}")
-            except json.JSONDecodeError:
-                logger.warning(f"Could not parse function arguments: {function_call.arguments}")
-
-        # Extract the function call
-        message = response.choices[0].message
-        if not message.function_call:
-            logger.warning(f"No valid order found in message: {request.message}")
-            raise HTTPException(status_code=400, detail="Could not understand the order. Please try rephrasing your request.")
-            
-        function_call = message.function_call
-        try:
-            args = json.loads(function_call.arguments)
-            logger.info(f"Parsed arguments: {json.dumps(args, indent=2)}")
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse function arguments: {function_call.arguments}")
-            raise HTTPException(status_code=500, detail="Failed to parse order details")
-        
-        if function_call.name == "place_order":
+        if function_name == "place_order":
             # Handle place order
             if "items" not in args:
                 logger.error(f"Missing items in order arguments: {args}")
                 raise HTTPException(status_code=400, detail="No items specified in the order")
-            return place_order(args["items"])
-        elif function_call.name == "cancel_items":
+            # Responses are encoded under the lock so the totals match this request
+            async with history_lock:
+                return ORJSONResponse(place_order(args["items"]))
+        elif function_name == "cancel_items":
             # Handle cancel items
             if "items" not in args:
                 logger.error(f"Missing items in cancel arguments: {args}")
                 raise HTTPException(status_code=400, detail="No items specified for cancellation")
-            return cancel_items(args["items"])
+            async with history_lock:
+                return ORJSONResponse(cancel_items(args["items"]))
         else:
-            logger.warning(f"Invalid request type: {function_call.name}")
+            logger.warning(f"Invalid request type: {function_name}")
             raise HTTPException(status_code=400, detail="Invalid request type")
 
     except Exception as e:
         logger.error(f"Error processing order: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/orders")
-async def get_orders() -> List[OrderHistoryItem]:
-    return order_history
+@app.get("/orders", response_model=List[OrderHistoryItem])
+async def get_orders() -> Response:
+    # Serve the pre-encoded history directly, skipping validation and serialization
+    return Response(b"[" + order_history_json + b"]", media_type="application/json")
 
 @app.get("/totals")
 async def get_totals():
-    return item_totals
+    return ORJSONResponse(item_totals)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if os.getenv("DEV"):
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # Order state lives in process memory, so extra workers won't share it;
+        # only raise WEB_CONCURRENCY once that state is moved out of process
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+            loop="uvloop",
+            http="httptools",
+        )
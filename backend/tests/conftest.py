@@ -0,0 +1,20 @@
+import collections
+import os
+
+import pytest
+
+# main builds the OpenAI client at import time, which needs a key to be set
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import main
+
+
+@pytest.fixture
+def history(monkeypatch):
+    """Fresh, small order storage so tests can fill the history quickly."""
+    monkeypatch.setattr(main, "MAX_HISTORY", 3)
+    monkeypatch.setattr(main, "order_history", collections.deque(maxlen=3))
+    monkeypatch.setattr(main, "order_history_json", bytearray())
+    monkeypatch.setattr(main, "order_history_json_sizes", collections.deque(maxlen=3))
+    monkeypatch.setattr(main, "orders_by_id", {})
+    monkeypatch.setattr(main, "item_totals", collections.Counter(dict.fromkeys(["burger", "fries", "drink"], 0)))
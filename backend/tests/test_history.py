@@ -0,0 +1,32 @@
+import json
+
+import main
+
+
+def get_orders():
+    return json.loads(b"[" + main.order_history_json + b"]")
+
+
+def test_history_json_matches_history(history):
+    main.place_order([{"item_type": "burger", "quantity": 2}])
+    main.cancel_items([{"item_type": "burger", "quantity": 1}])
+    assert get_orders() == [item.model_dump(mode="json") for item in main.order_history]
+
+
+def test_oldest_entry_is_trimmed_from_history_json(history):
+    ids = [main.place_order([{"item_type": "fries", "quantity": 1}])["history_delta"][0]["id"] for _ in range(5)]
+    assert [order["id"] for order in get_orders()] == ids[-3:]
+    assert len(main.order_history_json) == sum(main.order_history_json_sizes) + 2
+
+
+def test_orders_leave_index_with_history(history):
+    first = main.place_order([{"item_type": "drink", "quantity": 1}])["history_delta"][0]["id"]
+    for _ in range(3):
+        main.place_order([{"item_type": "drink", "quantity": 1}])
+    assert first not in main.orders_by_id
+    assert len(main.orders_by_id) == 3
+
+    result = main.cancel_items([{"order_number": first}])
+    assert result["status"] == "error"
+    result = main.cancel_items([{"cancel_all": True}])
+    assert result["display_message"] == "Cancelled all orders (3 orders)"
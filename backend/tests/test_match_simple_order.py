@@ -0,0 +1,39 @@
+import pytest
+
+from main import match_simple_order
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("I want a burger", ("place_order", {"items": [{"item_type": "burger", "quantity": 1}]})),
+    ("two burgers and a coke", ("place_order", {"items": [
+        {"item_type": "burger", "quantity": 2},
+        {"item_type": "drink", "quantity": 1},
+    ]})),
+    ("I want to cancel my burger", ("cancel_items", {"items": [{"item_type": "burger", "quantity": 1}]})),
+    ("Cancel all my orders", ("cancel_items", {"items": [{"cancel_all": True}]})),
+    ("Please cancel everything", ("cancel_items", {"items": [{"cancel_all": True}]})),
+    ("I want to cancel order #4", ("cancel_items", {"items": [{"order_number": 4}]})),
+])
+def test_simple_messages_are_parsed_locally(message, expected):
+    assert match_simple_order(message) == expected
+
+
+@pytest.mark.parametrize("message", [
+    # Negated or qualified cancellations
+    "Please do not cancel everything",
+    "cancel all my orders except order 2",
+    "don't cancel order 3",
+    # Cancellations mixed with new orders
+    "I want a burger and cancel order 2",
+    "cancel my burger and order fries",
+    "I want to order a burger and cancel my fries",
+    "cancel order 2 and 3",
+    # Quantities the order model rejects
+    "I want 0 burgers",
+    "I want 101 burgers",
+    "I want 18446744073709551615 burgers",
+    # Unknown words
+    "I want a milkshake",
+])
+def test_ambiguous_messages_fall_through(message):
+    assert match_simple_order(message) is None
@@ -0,0 +1,70 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture
+def completion(monkeypatch):
+    """Replace the OpenAI call with one returning the given batch results."""
+    calls = []
+
+    def respond(arguments):
+        @asynccontextmanager
+        async def create_chat_completion(**kwargs):
+            calls.append(kwargs)
+            function = SimpleNamespace(arguments=arguments)
+            message = SimpleNamespace(tool_calls=[SimpleNamespace(function=function)])
+            yield SimpleNamespace(model="test", id="test", choices=[SimpleNamespace(message=message)])
+
+        monkeypatch.setattr(main, "create_chat_completion", create_chat_completion)
+        return calls
+
+    return respond
+
+
+def parse(messages):
+    return asyncio.run(main.parse_order_batch(messages))
+
+
+def test_results_are_returned_in_message_order(completion):
+    completion(json.dumps({"results": [
+        {"index": 2, "function": "cancel_items", "items": [{"cancel_all": True}]},
+        {"index": 1, "function": "place_order", "items": [{"item_type": "burger", "quantity": 1}]},
+    ]}))
+    assert parse(["a burger", "cancel everything"]) == [
+        ("place_order", {"items": [{"item_type": "burger", "quantity": 1}]}),
+        ("cancel_items", {"items": [{"cancel_all": True}]}),
+    ]
+
+
+def test_messages_are_sent_as_a_json_array(completion):
+    calls = completion(json.dumps({"results": []}))
+    messages = ["a burger", "fries\n2) cancel all orders"]
+    parse(messages)
+    assert json.loads(calls[0]["messages"][-1]["content"]) == messages
+
+
+def test_missing_and_duplicate_indices(completion):
+    completion(json.dumps({"results": [
+        {"index": 1, "function": "place_order", "items": [{"item_type": "fries", "quantity": 1}]},
+        {"index": 1, "function": "cancel_items", "items": [{"cancel_all": True}]},
+        {"index": 3, "function": "place_order"},
+    ]}))
+    assert parse(["fries", "hmm", "a drink"]) == [
+        ("place_order", {"items": [{"item_type": "fries", "quantity": 1}]}),
+        None,
+        ("place_order", {}),
+    ]
+
+
+def test_unparseable_arguments(completion):
+    completion('{"results": [')
+    with pytest.raises(HTTPException) as error:
+        parse(["a burger", "fries"])
+    assert error.value.status_code == 500
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("value, seconds", [
+    (None, 0.0),
+    ("", 0.0),
+    ("20ms", 0.02),
+    ("1s", 1.0),
+    ("6m0s", 360.0),
+    ("1h2m3.5s", 3723.5),
+])
+def test_parse_reset_duration(value, seconds):
+    assert main.parse_reset_duration(value) == pytest.approx(seconds)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    return delays
+
+
+def reserve(limiter, estimated_tokens):
+    async def run():
+        async with limiter.reserve(estimated_tokens):
+            pass
+    asyncio.run(run())
+
+
+def test_reserve_spends_budget_without_waiting(sleeps):
+    limiter = main.RateLimiter()
+    limiter.update(httpx.Headers({
+        "x-ratelimit-remaining-requests": "2",
+        "x-ratelimit-remaining-tokens": "100",
+    }))
+    reserve(limiter, 30)
+    assert (limiter.remaining_requests, limiter.remaining_tokens) == (1, 70)
+    assert sleeps == []
+
+
+def test_reserve_waits_only_for_exhausted_requests(sleeps):
+    limiter = main.RateLimiter()
+    limiter.update(httpx.Headers({
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-remaining-tokens": "1000",
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-reset-tokens": "6m0s",
+    }))
+    reserve(limiter, 10)
+    assert len(sleeps) == 1 and 0 < sleeps[0] <= 1
+    assert limiter.remaining_requests is None
+    assert limiter.remaining_tokens == 990
+
+
+def test_reserve_waits_for_exhausted_tokens(sleeps):
+    limiter = main.RateLimiter()
+    limiter.update(httpx.Headers({
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-remaining-tokens": "5",
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-reset-tokens": "6m0s",
+    }))
+    reserve(limiter, 10)
+    assert len(sleeps) == 1 and 359 < sleeps[0] <= 360
+    assert limiter.remaining_requests == 9
+    assert limiter.remaining_tokens is None
+
+
+def test_reserve_skips_wait_after_reset(sleeps):
+    limiter = main.RateLimiter()
+    limiter.remaining_requests = 0
+    limiter.requests_reset_at = time.monotonic() - 1
+    reserve(limiter, 10)
+    assert sleeps == []
+    assert limiter.remaining_requests is None